@@ -3,13 +3,9 @@ import numpy as np
 from tqdm import tqdm
 from comfy.utils import ProgressBar
 from .mask_utils import (
-    create_distance_transform, 
-    normalize_array, 
-    apply_blur, 
-    apply_easing, 
+    easing_curve,
     calculate_optical_flow, 
-    apply_blur, 
-    normalize_array
+    OpticalFlowState
     )
 from abc import ABC, abstractmethod
 import pymunk 
@@ -42,6 +38,8 @@ class MaskBase(ABC):
         self.tqdm_bar = None
         self.current_progress = 0
         self.total_steps = 0
+        self.progress_stride = 1
+        self.pending_progress = 0
 
     def add_pre_processor(self, func):
         self.pre_processors.append(func)
@@ -66,15 +64,26 @@ class MaskBase(ABC):
         self.tqdm_bar = tqdm(total=total_steps, desc=desc, leave=False)
         self.current_progress = 0
         self.total_steps = total_steps
+        # Progress bars are only refreshed every progress_stride steps
+        self.progress_stride = max(1, total_steps // 200)
+        self.pending_progress = 0
 
     def update_progress(self, step=1):
         self.current_progress += step
-        if self.progress_bar:
-            self.progress_bar.update(step)
-        if self.tqdm_bar:
-            self.tqdm_bar.update(step)
+        self.pending_progress += step
+        if self.pending_progress >= self.progress_stride:
+            self.flush_progress()
+
+    def flush_progress(self):
+        if self.pending_progress > 0:
+            if self.progress_bar:
+                self.progress_bar.update(self.pending_progress)
+            if self.tqdm_bar:
+                self.tqdm_bar.update(self.pending_progress)
+        self.pending_progress = 0
 
     def end_progress(self):
+        self.flush_progress()
         if self.tqdm_bar:
             self.tqdm_bar.close()
         self.progress_bar = None
@@ -94,10 +103,16 @@ class MaskBase(ABC):
         original_masks_np = original_masks.cpu().numpy() if isinstance(original_masks, torch.Tensor) else original_masks
         num_frames = processed_masks_np.shape[0]
 
+        if not self.pre_processors and not self.post_processors:
+            return self.apply_batched_mask_operation(processed_masks_np, original_masks_np, invert, subtract_original, grow_with_blur)
+
+        # The distance transform only depends on the original masks, so compute it once per clip
+        subtraction_masks = self.create_subtraction_mask(original_masks_np, subtract_original) if subtract_original > 0 else None
+
         self.start_progress(num_frames, desc="Applying mask operation")
 
-        result = []
-        for processed_mask, original_mask in zip(processed_masks_np, original_masks_np):
+        result = np.empty(processed_masks_np.shape, dtype=np.float32)
+        for i, processed_mask in enumerate(processed_masks_np):
             # Pre-processing
             processed_mask = self.pre_process(processed_mask)
 
@@ -105,28 +120,61 @@ class MaskBase(ABC):
                 processed_mask = 1 - processed_mask
 
             if grow_with_blur > 0:
-                processed_mask = apply_blur(processed_mask, grow_with_blur)
+                processed_mask = cv2.GaussianBlur(np.ascontiguousarray(processed_mask, dtype=np.float32), (0, 0), sigmaX=float(grow_with_blur), borderType=cv2.BORDER_REPLICATE)
 
             # Apply subtract_original as the final step
-            if subtract_original > 0:
-                dist_transform = create_distance_transform(original_mask)
-                dist_transform = normalize_array(dist_transform)
-                threshold = 1 - subtract_original
-                subtraction_mask = dist_transform > threshold
-                processed_mask[subtraction_mask] = 0
+            if subtraction_masks is not None:
+                processed_mask[subtraction_masks[i]] = 0
 
             # Post-processing
             processed_mask = self.post_process(processed_mask)
 
             # Ensure the final mask is clipped between 0 and 1
-            processed_mask = np.clip(processed_mask, 0, 1)
-
-            result.append(processed_mask)
+            result[i] = np.clip(processed_mask, 0, 1)
             self.update_progress()
 
         self.end_progress()
 
-        return torch.from_numpy(np.stack(result)).float()
+        return torch.from_numpy(result)
+
+    def apply_batched_mask_operation(self, processed_masks_np: np.ndarray, original_masks_np: np.ndarray, invert: bool, subtract_original: float, grow_with_blur: float) -> torch.Tensor:
+        # Same steps as the per-frame loop, run over the whole (F, H, W) stack at once
+        num_frames = processed_masks_np.shape[0]
+
+        self.start_progress(num_frames, desc="Applying mask operation")
+
+        if grow_with_blur > 0:
+            processed = np.subtract(1, processed_masks_np, dtype=np.float32) if invert else processed_masks_np.astype(np.float32)
+
+            # GaussianBlur is separable and can write each frame back into the stack in place
+            for i in range(num_frames):
+                cv2.GaussianBlur(processed[i], (0, 0), sigmaX=float(grow_with_blur), dst=processed[i], borderType=cv2.BORDER_REPLICATE)
+
+            np.clip(processed, 0, 1, out=processed)
+        else:
+            # Without a blur in between, the copy and the clip are one pass since 1 - clip(m) == clip(1 - m)
+            processed = np.clip(processed_masks_np, 0, 1, out=np.empty(processed_masks_np.shape, dtype=np.float32))
+            if invert:
+                np.subtract(1, processed, out=processed)
+
+        if subtract_original > 0:
+            # Zeroing after the clip gives the same result, 0 is already inside [0, 1]
+            np.copyto(processed, 0, where=self.create_subtraction_mask(original_masks_np, subtract_original))
+
+        self.update_progress(num_frames)
+        self.end_progress()
+
+        return torch.from_numpy(processed).float()
+
+    def create_subtraction_mask(self, original_masks_np: np.ndarray, subtract_original: float) -> np.ndarray:
+        # Scale the threshold to each frame's distance range rather than normalizing the distance transform
+        threshold = 1 - subtract_original
+        subtraction_mask = np.empty(original_masks_np.shape, dtype=bool)
+        for i, original_mask in enumerate(original_masks_np):
+            dist_transform = cv2.distanceTransform((original_mask > 0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            dist_min, dist_max = dist_transform.min(), dist_transform.max()
+            np.greater(dist_transform, dist_min + threshold * (dist_max - dist_min), out=subtraction_mask[i])
+        return subtraction_mask
 
     @abstractmethod
     def main_function(self, *args, **kwargs) -> Tuple[torch.Tensor]:
@@ -162,40 +210,46 @@ class TemporalMaskBase(MaskBase, ABC):
         return self.process_single_mask(mask, strength, **kwargs)
 
     def apply_temporal_mask_operation(self, masks: torch.Tensor, strength: float, start_frame: int, end_frame: int, effect_duration: int, temporal_easing: str, palindrome: bool, **kwargs) -> Tuple[torch.Tensor]:
-        masks_np = masks.cpu().numpy() if isinstance(masks, torch.Tensor) else masks
-        num_frames = masks_np.shape[0]
+        masks = masks if isinstance(masks, torch.Tensor) else torch.from_numpy(masks)
+        num_frames = masks.shape[0]
         
         end_frame = end_frame if end_frame > 0 else num_frames
         effect_duration = min(effect_duration, num_frames) if effect_duration > 0 else (end_frame - start_frame)
-        if temporal_easing == "None":
-            easing_values = np.ones(effect_duration)
-        elif palindrome:
-            half_duration = effect_duration // 2
-            t = np.linspace(0, 1, half_duration)
-            easing_values = apply_easing(t, temporal_easing)
-            easing_values = np.concatenate([easing_values, easing_values[::-1]])
+
+        window_start = min(start_frame, num_frames)
+        window_end = max(window_start, min(end_frame, num_frames))
+
+        if temporal_easing.lower() == "none":
+            # Constant easing, every frame in the window gets the full strength
+            temporal_strengths = np.full(window_end - window_start, float(strength))
         else:
-            t = np.linspace(0, 1, effect_duration)
-            easing_values = apply_easing(t, temporal_easing)
-        
+            if palindrome:
+                easing_values = easing_curve(effect_duration // 2, temporal_easing)
+                easing_values = np.concatenate([easing_values, easing_values[::-1]])
+            else:
+                easing_values = easing_curve(effect_duration, temporal_easing)
+
+            # Easing repeats every len(easing_values) frames when the window is longer than effect_duration
+            window_positions = np.arange(window_end - window_start) % len(easing_values)
+            temporal_strengths = strength * easing_values[window_positions]
+
         self.start_progress(num_frames, desc="Applying temporal mask operation")
         
-        result = []
-        for i in range(num_frames):
-            if i < start_frame or i >= end_frame:
-                result.append(masks_np[i])
-            else:
-                frame_in_effect = i - start_frame
-                progress = easing_values[frame_in_effect % len(easing_values)]
-                temporal_strength = strength * progress
-                processed_mask = self.process_single_mask(masks_np[i], temporal_strength, frame_index=i, **kwargs)
-                result.append(processed_mask)
-            
+        # Frames outside the effect window pass through as tensors, only the window is converted to numpy
+        result = torch.empty(masks.shape, dtype=torch.float32)
+        result[:window_start] = masks[:window_start]
+        result[window_end:] = masks[window_end:]
+        self.update_progress(num_frames - (window_end - window_start))
+
+        window_np = masks[window_start:window_end].contiguous().cpu().numpy()
+        result_window = result[window_start:window_end].numpy()
+        for i, mask in enumerate(window_np):
+            result_window[i] = self.process_single_mask(mask, temporal_strengths[i], frame_index=window_start + i, **kwargs)
             self.update_progress()
         
         self.end_progress()
         
-        return (torch.from_numpy(np.stack(result)).float(),)
+        return (result,)
 
     def main_function(self, masks, strength, invert, subtract_original, grow_with_blur, start_frame, end_frame, effect_duration, temporal_easing, palindrome, **kwargs):
         original_masks = masks
@@ -225,6 +279,7 @@ class ParticleSystemMaskBase(MaskBase, ABC):
                 "vortices": ("VORTEX",),
                 "wells": ("GRAVITY_WELL",),
                 "well_strength_multiplier": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.1}),
+                "particle_collisions": ("BOOLEAN", {"default": True}),
             }
         }
 
@@ -240,7 +295,15 @@ class ParticleSystemMaskBase(MaskBase, ABC):
         self.space = pymunk.Space()
         self.space.gravity = pymunk.Vec2d(0, 0)
         self.particles: List[pymunk.Body] = []
+        # Per particle creation times and lifetimes, parallel to self.particles
+        self.creation_times = np.empty(0, dtype=np.float32)
+        self.lifetimes = np.empty(0, dtype=np.float32)
         self.mask_shapes: List[pymunk.Shape] = []
+        self.mask_segments = np.empty((0, 2, 2))
+        self.mask_boundary_signature = None
+        self.mask_boundary_buffer = None
+        self.mask_boundary_scale = 0.5
+        self.use_pymunk = True
         self.particles_to_emit = []  # List of fractional particle counts for each emitter
         self.total_particles_emitted = 0
         self.max_particles = 0
@@ -265,29 +328,44 @@ class ParticleSystemMaskBase(MaskBase, ABC):
                 'position': pymunk.Vec2d(x, y),
                 'strength': well['strength'],
                 'radius': well['radius'],
+                'radius_sq': well['radius'] ** 2,
                 'type': well['type']  # 'attract' or 'repel'
             }
             self.gravity_wells.append(well_obj)
 
-    def apply_gravity_well_force(self, particle):
-        for well in self.gravity_wells:
-            offset = well['position'] - particle.position
-            distance = offset.length
-            if distance < well['radius']:
-                force_magnitude = well['strength'] * (1 - distance / well['radius']) * self.well_strength_multiplier
-                force_direction = offset.normalized()
-                if well['type'] == 'repel':
-                    force_direction = -force_direction
-                force = force_direction * force_magnitude
-                particle.apply_force_at_world_point(force, particle.position)
+    def apply_gravity_well_force(self, positions: np.ndarray) -> np.ndarray:
+        forces = np.zeros_like(positions)
+        if not self.gravity_wells or len(positions) == 0:
+            return forces
+
+        well_positions = np.array([tuple(well['position']) for well in self.gravity_wells])
+        strengths = np.array([well['strength'] for well in self.gravity_wells], dtype=np.float64)
+        radii = np.array([well['radius'] for well in self.gravity_wells], dtype=np.float64)
+        radii_sq = np.array([well['radius_sq'] for well in self.gravity_wells], dtype=np.float64)
+        signs = np.array([-1.0 if well['type'] == 'repel' else 1.0 for well in self.gravity_wells])
+
+        # Squared distances decide which (particle, well) pairs interact, the sqrt is only taken for those
+        offsets = well_positions[None, :, :] - positions[:, None, :]
+        particle_idx, well_idx = np.nonzero(offsets[..., 0] ** 2 + offsets[..., 1] ** 2 < radii_sq)
+        offset = offsets[particle_idx, well_idx]
+        distance = np.sqrt(offset[:, 0] ** 2 + offset[:, 1] ** 2)
+        direction = np.divide(offset, distance[:, None], out=np.zeros_like(offset), where=distance[:, None] > 0)
+
+        force_magnitude = strengths[well_idx] * (1 - distance / radii[well_idx]) * self.well_strength_multiplier
+
+        # Forces from all wells accumulate, like repeated apply_force_at_world_point calls
+        np.add.at(forces, particle_idx, direction * signs[well_idx, None] * force_magnitude[:, None])
+        return forces
 
     def process_mask(self, masks: torch.Tensor, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
-        masks_np = masks.cpu().numpy() if isinstance(masks, torch.Tensor) else masks
-        num_frames, height, width = masks_np.shape
+        masks = masks if isinstance(masks, torch.Tensor) else torch.from_numpy(masks)
+        num_frames, height, width = masks.shape
         
         start_frame = kwargs.get('start_frame', 0)
         end_frame = kwargs.get('end_frame', num_frames)
         end_frame = end_frame if end_frame > 0 else num_frames
+        window_start = min(start_frame, num_frames)
+        window_end = max(window_start, min(end_frame, num_frames))
         
         self.setup_particle_system(width, height, **kwargs)
         
@@ -295,23 +373,25 @@ class ParticleSystemMaskBase(MaskBase, ABC):
         
         self.start_progress(num_frames, desc="Processing particle system mask")
         
-        mask_result = []
-        image_result = []
-        for i in range(num_frames):
-            if i < start_frame or i >= end_frame:
-                mask_result.append(masks_np[i])
-                image_result.append(np.stack([masks_np[i]] * 3, axis=-1))
-            else:
-                self.update_particle_system(1.0 / 30.0, masks_np[i], respect_mask_boundary)
-                processed_mask, processed_image = self.process_single_mask(masks_np[i], frame_index=i, **kwargs)
-                mask_result.append(processed_mask)
-                image_result.append(processed_image)
-            
+        # Frames outside the effect window pass through as tensors, only the window is converted to numpy
+        mask_result = torch.empty((num_frames, height, width), dtype=torch.float32)
+        image_result = torch.empty((num_frames, height, width, 3), dtype=torch.float32)
+        for passthrough in (slice(None, window_start), slice(window_end, None)):
+            mask_result[passthrough] = masks[passthrough]
+            image_result[passthrough] = masks[passthrough].unsqueeze(-1)
+        self.update_progress(num_frames - (window_end - window_start))
+
+        window_np = masks[window_start:window_end].contiguous().cpu().numpy()
+        mask_window = mask_result[window_start:window_end].numpy()
+        image_window = image_result[window_start:window_end].numpy()
+        for i, mask in enumerate(window_np):
+            self.update_particle_system(1.0 / 30.0, mask, respect_mask_boundary)
+            mask_window[i], image_window[i] = self.process_single_mask(mask, frame_index=window_start + i, **kwargs)
             self.update_progress()
         
         self.end_progress()
         
-        return torch.from_numpy(np.stack(mask_result)).float(), torch.from_numpy(np.stack(image_result)).float()
+        return mask_result, image_result
 
     def setup_particle_system(self, width: int, height: int, **kwargs):
         self.space.gravity = pymunk.Vec2d(float(kwargs['wind_strength']), float(kwargs['gravity']))
@@ -327,20 +407,23 @@ class ParticleSystemMaskBase(MaskBase, ABC):
         self.particles_to_emit = [0] * len(self.emitters)
         self.total_particles_emitted = 0
 
+        # with particle collisions disabled and no mask boundary, the particles are integrated directly instead of by pymunk
+        self.use_pymunk = bool(kwargs.get('respect_mask_boundary', False)) or bool(kwargs.get('particle_collisions', True))
+
 
         for emitter in self.emitters:
-            emitter_pos = (float(emitter['emitter_x']) * width, float(emitter['emitter_y']) * height)
-            particle_direction = math.radians(float(emitter['particle_direction']))
-            particle_spread = math.radians(float(emitter['particle_spread']))
-            particle_speed = float(emitter['particle_speed'])
-            particle_size = float(emitter['particle_size'])
             emitter['color'] = self.string_to_rgb(emitter['color'])  # Convert color here
+            emitter.pop('cache', None)
             initial_plume = float(emitter['initial_plume'])
             initial_particle_count = int(self.max_particles * initial_plume / len(self.emitters))
             
-            # Create initial plume of particles for this emitter
-            for _ in range(initial_particle_count):
-                self.emit_particle(emitter, height, width, 0)
+            # Create initial plume of particles for this emitter, drawing all of its velocities at once
+            cache = self.get_emitter_cache(emitter, height, width)
+            angles = np.random.uniform(cache['dir_rad'] - cache['spread_half_rad'], cache['dir_rad'] + cache['spread_half_rad'], size=initial_particle_count)
+            velocities = np.stack([np.cos(angles), np.sin(angles)], axis=-1) * cache['speed']
+            for velocity in velocities.tolist():
+                self.emit_particle(emitter, height, width, 0, velocity)
+        self.track_new_particles()
 
         # Check for provided wells and vortices
         if 'vortices' in kwargs:
@@ -372,6 +455,7 @@ class ParticleSystemMaskBase(MaskBase, ABC):
                 'velocity': pymunk.Vec2d(random.uniform(-1, 1), random.uniform(-1, 1)).normalized() * vortex['movement_speed'],
                 'strength': vortex['strength'],
                 'radius': vortex['radius'],
+                'radius_sq': vortex['radius'] ** 2,
                 'inward_factor': vortex['inward_factor'],
             }
             self.vortices.append(vortex_obj)
@@ -385,28 +469,37 @@ class ParticleSystemMaskBase(MaskBase, ABC):
             if vortex['position'].y < 0 or vortex['position'].y > height:
                 vortex['velocity'].y *= -1
 
-    def apply_vortex_force(self, particle, dt):
-        for vortex in self.vortices:
-            offset = particle.position - vortex['position']
-            distance = offset.length
-
-
-            if distance < vortex['radius']:
-                tangent = pymunk.Vec2d(-offset.y, offset.x).normalized()
-                
-                radial = -offset.normalized()
-                
-                strength = vortex['strength']
-                
-                tangential_velocity = tangent * strength * (distance / vortex['radius'])
-                radial_velocity = radial * strength * vortex['inward_factor']
-                
-                new_velocity = tangential_velocity + radial_velocity
-                
-                particle.velocity = new_velocity
-
-
-                
+    def apply_vortex_force(self, positions: np.ndarray, velocities: np.ndarray) -> np.ndarray:
+        if not self.vortices or len(positions) == 0:
+            return velocities
+
+        vortex_positions = np.array([tuple(vortex['position']) for vortex in self.vortices])
+        strengths = np.array([vortex['strength'] for vortex in self.vortices], dtype=np.float64)
+        radii = np.array([vortex['radius'] for vortex in self.vortices], dtype=np.float64)
+        radii_sq = np.array([vortex['radius_sq'] for vortex in self.vortices], dtype=np.float64)
+        inward_factors = np.array([vortex['inward_factor'] for vortex in self.vortices], dtype=np.float64)
+
+        # Squared distances decide which (particle, vortex) pairs interact, the sqrt is only taken for those
+        offsets = positions[:, None, :] - vortex_positions[None, :, :]
+        inside = offsets[..., 0] ** 2 + offsets[..., 1] ** 2 < radii_sq
+        particle_idx = np.nonzero(inside.any(axis=1))[0]
+        if len(particle_idx) == 0:
+            return velocities
+
+        # Each vortex overwrites the velocity, so only the last vortex containing a particle matters
+        vortex_idx = inside.shape[1] - 1 - np.argmax(inside[particle_idx, ::-1], axis=1)
+        offset = offsets[particle_idx, vortex_idx]
+        distance = np.sqrt(offset[:, 0] ** 2 + offset[:, 1] ** 2)
+        direction = np.divide(offset, distance[:, None], out=np.zeros_like(offset), where=distance[:, None] > 0)
+
+        strength = strengths[vortex_idx, None]
+        tangent = np.stack([-direction[:, 1], direction[:, 0]], axis=-1)
+        tangential_velocity = tangent * strength * (distance / radii[vortex_idx])[:, None]
+        radial_velocity = -direction * strength * inward_factors[vortex_idx, None]
+
+        velocities = velocities.copy()
+        velocities[particle_idx] = tangential_velocity + radial_velocity
+        return velocities
 
     def update_particle_system(self, dt: float, current_mask: np.ndarray, respect_mask_boundary: bool):
         if respect_mask_boundary:
@@ -417,80 +510,139 @@ class ParticleSystemMaskBase(MaskBase, ABC):
         sub_steps = 5
         sub_dt = dt / sub_steps
         
+        gravity = np.array(tuple(self.space.gravity))
+        positions, velocities = self.get_particle_state(self.particles)
         for _ in range(sub_steps):
             # Emit new particles from each emitter
+            num_particles = len(self.particles)
             for i, emitter in enumerate(self.emitters):
                 self.particles_to_emit[i] += emitter['emission_rate'] * sub_dt
                 while self.particles_to_emit[i] >= 1 and self.total_particles_emitted < self.max_particles:
                     self.emit_particle(emitter, height,width, i)
                     self.particles_to_emit[i] -= 1
+            self.track_new_particles()
             
-            # Update particle positions
-            for particle in self.particles:
-                self.apply_vortex_force(particle,sub_dt)
-                self.apply_gravity_well_force(particle)
-                old_pos = particle.position
-                new_pos = old_pos + particle.velocity * sub_dt
-                if respect_mask_boundary:
-                    self.check_particle_mask_collision(particle, old_pos, new_pos)
-                particle.position = new_pos
-            
-            self.space.step(sub_dt)
+            # Update particle positions, gathered from and scattered back to the bodies in one pass each
+            if self.use_pymunk:
+                positions, velocities = self.get_particle_state(self.particles)
+            elif len(self.particles) > num_particles:
+                new_positions, new_velocities = self.get_particle_state(self.particles[num_particles:])
+                positions = np.concatenate([positions, new_positions])
+                velocities = np.concatenate([velocities, new_velocities])
+            velocities = self.apply_vortex_force(positions, velocities)
+            forces = self.apply_gravity_well_force(positions)
+            new_positions = positions + velocities * sub_dt
+            if respect_mask_boundary:
+                velocities = self.check_particle_mask_collision(positions, new_positions, velocities)
+
+            if self.use_pymunk:
+                self.set_particle_state(self.particles, new_positions, velocities, forces)
+                self.space.step(sub_dt)
+            else:
+                # Same update pymunk applies to a free body of mass 1
+                velocities = velocities + (gravity + forces) * sub_dt
+                positions = new_positions + velocities * sub_dt
+
+        if not self.use_pymunk:
+            self.set_particle_state(self.particles, positions, velocities, np.zeros_like(positions))
         
         current_time = self.space.current_time_step
-        self.particles = [p for p in self.particles if current_time - p.creation_time < p.lifetime]
+        alive = current_time - self.creation_times < self.lifetimes
+        if not alive.all():
+            self.particles = [self.particles[i] for i in np.nonzero(alive)[0]]
+            self.creation_times = self.creation_times[alive]
+            self.lifetimes = self.lifetimes[alive]
+
+    def track_new_particles(self):
+        count = len(self.particles) - len(self.creation_times)
+        if count > 0:
+            self.creation_times = np.concatenate([self.creation_times, np.full(count, self.space.current_time_step, dtype=np.float32)])
+            self.lifetimes = np.concatenate([self.lifetimes, np.full(count, self.particle_lifetime, dtype=np.float32)])
 
-    def check_particle_mask_collision(self, particle, old_pos, new_pos):
-        for segment in self.mask_shapes:
-            if self.line_segment_intersect(old_pos, new_pos, pymunk.Vec2d(*segment.a), pymunk.Vec2d(*segment.b)):
-                segment_vec = pymunk.Vec2d(*segment.b) - pymunk.Vec2d(*segment.a)
-                normal = segment_vec.perpendicular_normal()
-                
-                # Reflect velocity
-                v = particle.velocity
-                reflection = v - 2 * v.dot(normal) * normal
-                
-                particle.velocity = reflection * 0.9  # Reduce velocity slightly on bounce
-                
-                # Move particle out of the boundary
-                penetration_depth = (new_pos - old_pos).dot(normal)
-                particle.position = old_pos + normal * (penetration_depth + particle.size / 2 + 1)
-                break
+    @staticmethod
+    def get_particle_state(particles):
+        positions = np.array([particle.position for particle in particles]).reshape(-1, 2)
+        velocities = np.array([particle.velocity for particle in particles]).reshape(-1, 2)
+        return positions, velocities
+
+    @staticmethod
+    def set_particle_state(particles, positions, velocities, forces):
+        for particle, position, velocity, force in zip(particles, positions.tolist(), velocities.tolist(), forces.tolist()):
+            particle.velocity = velocity
+            particle.force = force
+            particle.position = position
+
+    def check_particle_mask_collision(self, old_positions: np.ndarray, new_positions: np.ndarray, velocities: np.ndarray) -> np.ndarray:
+        if len(self.mask_segments) == 0 or len(velocities) == 0:
+            return velocities
+
+        segment_a = self.mask_segments[:, 0]
+        segment_b = self.mask_segments[:, 1]
+
+        # (particles, segments) intersection table, each particle bounces off the first segment it crosses
+        hits = self.line_segment_intersect(old_positions[:, None, :], new_positions[:, None, :], segment_a[None, :, :], segment_b[None, :, :])
+        hit = hits.any(axis=1)
+        if not hit.any():
+            return velocities
+
+        segment_vecs = segment_b - segment_a
+        segment_lengths = np.sqrt(segment_vecs[:, 0] ** 2 + segment_vecs[:, 1] ** 2)
+        normals = np.divide(np.stack([-segment_vecs[:, 1], segment_vecs[:, 0]], axis=-1), segment_lengths[:, None],
+                            out=np.zeros_like(segment_vecs), where=segment_lengths[:, None] > 0)
+        normals = normals[np.argmax(hits[hit], axis=1)]
+
+        # Reflect velocity
+        v = velocities[hit]
+        dots = v[:, 0] * normals[:, 0] + v[:, 1] * normals[:, 1]
+        reflections = v - 2 * dots[:, None] * normals
+
+        velocities = velocities.copy()
+        velocities[hit] = reflections * 0.9  # Reduce velocity slightly on bounce
+        return velocities
 
     def line_segment_intersect(self, p1, p2, p3, p4):
         def ccw(A, B, C):
-            return (C.y-A.y) * (B.x-A.x) > (B.y-A.y) * (C.x-A.x)
+            return (C[..., 1]-A[..., 1]) * (B[..., 0]-A[..., 0]) > (B[..., 1]-A[..., 1]) * (C[..., 0]-A[..., 0])
         
-        return ccw(p1,p3,p4) != ccw(p2,p3,p4) and ccw(p1,p2,p3) != ccw(p1,p2,p4)
-
-    def emit_particle(self, emitter, height, width, emitter_index):
-        #width, height = self.space.shape
-        emitter_pos = (float(emitter['emitter_x']) * width, float(emitter['emitter_y']) * height)
-        particle_direction = math.radians(float(emitter['particle_direction']))
-        particle_spread = math.radians(float(emitter['particle_spread']))
-        particle_speed = float(emitter['particle_speed'])
-        particle_size = float(emitter['particle_size'])
-
-        angle = random.uniform(particle_direction - particle_spread/2, 
-                               particle_direction + particle_spread/2)
-        velocity = pymunk.Vec2d(math.cos(angle), math.sin(angle)) * particle_speed
+        return (ccw(p1,p3,p4) != ccw(p2,p3,p4)) & (ccw(p1,p2,p3) != ccw(p1,p2,p4))
+
+    @staticmethod
+    def get_emitter_cache(emitter, height, width):
+        # Parsed emitter fields, rebuilt whenever modulate_parameters moves or turns the emitter
+        if 'cache' not in emitter:
+            particle_size = float(emitter['particle_size'])
+            radius = particle_size / 2
+            emitter['cache'] = {
+                'pos': (float(emitter['emitter_x']) * width, float(emitter['emitter_y']) * height),
+                'dir_rad': math.radians(float(emitter['particle_direction'])),
+                'spread_half_rad': math.radians(float(emitter['particle_spread'])) / 2,
+                'speed': float(emitter['particle_speed']),
+                'size': particle_size,
+                'radius': radius,
+                'moment': pymunk.moment_for_circle(1, 0, radius),
+            }
+        return emitter['cache']
+
+    def emit_particle(self, emitter, height, width, emitter_index, velocity=None):
+        cache = self.get_emitter_cache(emitter, height, width)
+
+        if velocity is None:
+            angle = random.uniform(cache['dir_rad'] - cache['spread_half_rad'],
+                                   cache['dir_rad'] + cache['spread_half_rad'])
+            velocity = pymunk.Vec2d(math.cos(angle), math.sin(angle)) * cache['speed']
         
-        mass = 1
-        radius = particle_size / 2
-        moment = pymunk.moment_for_circle(mass, 0, radius)
-        particle = pymunk.Body(mass, moment)
-        particle.position = emitter_pos
+        particle = pymunk.Body(1, cache['moment'])
+        particle.position = cache['pos']
         particle.velocity = velocity
-        particle.creation_time = self.space.current_time_step
-        particle.lifetime = self.particle_lifetime
-        particle.size = particle_size
+        particle.size = cache['size']
         particle.color = emitter['color']
         
-        shape = pymunk.Circle(particle, radius)
+        shape = pymunk.Circle(particle, cache['radius'])
         shape.elasticity = 0.9
         shape.friction = 0.5
         
-        self.space.add(particle, shape)
+        if self.use_pymunk:
+            self.space.add(particle, shape)
         self.particles.append(particle)
         self.total_particles_emitted += 1
 
@@ -498,18 +650,34 @@ class ParticleSystemMaskBase(MaskBase, ABC):
 
         #TODO get the segments contiguous
 
+        if self.mask_boundary_buffer is None or self.mask_boundary_buffer.shape != mask.shape:
+            self.mask_boundary_buffer = np.empty(mask.shape, dtype=np.uint8)
+        np.copyto(self.mask_boundary_buffer, mask, casting='unsafe')
+
+        # Contours are traced at reduced resolution, the simplification below discards finer detail anyway
+        scale = self.mask_boundary_scale
+        mask_uint8 = self.mask_boundary_buffer
+        if scale != 1:
+            mask_uint8 = cv2.resize(mask_uint8, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+
+        # Mostly static masks produce the same contours every frame, keep the existing segments
+        mask_signature = (mask.shape, hash(mask_uint8.tobytes()))
+        if mask_signature == self.mask_boundary_signature:
+            return
+        self.mask_boundary_signature = mask_signature
+
         for shape in self.mask_shapes:
             self.space.remove(shape)
         self.mask_shapes.clear()
 
-        contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
         for contour in contours:
             # Simplify the contour
             epsilon = 0.01 * cv2.arcLength(contour, True)
             approx = cv2.approxPolyDP(contour, epsilon, True)
         
-            points = [tuple(map(float, point[0])) for point in approx]
+            points = [tuple(map(float, point[0] / scale)) for point in approx]
             
             if len(points) < 3:
                 continue
@@ -524,6 +692,8 @@ class ParticleSystemMaskBase(MaskBase, ABC):
                 self.space.add(segment)
                 self.mask_shapes.append(segment)
 
+        self.mask_segments = np.array([(tuple(segment.a), tuple(segment.b)) for segment in self.mask_shapes]).reshape(-1, 2, 2)
+
     def draw_particle(self, mask: np.ndarray, image: np.ndarray, particle: pymunk.Body) -> Tuple[np.ndarray, np.ndarray]:
         x, y = int(particle.position.x), int(particle.position.y)
         radius = int(particle.size / 2)
@@ -559,6 +729,7 @@ class ParticleSystemMaskBase(MaskBase, ABC):
 
                 # Update emitter position
                 emitter['position'] = (emitter['emitter_x'] * width, emitter['emitter_y'] * height)
+                emitter.pop('cache', None)
 
             #print(f"Frame {frame_index}, t={t:.2f}s, Emitter modulated: {emitter}")
 
@@ -597,17 +768,13 @@ class OpticalFlowMaskBase(MaskBase, ABC):
         if frame_index == 0 or frame_index >= len(images) - 1:
             return mask
 
-        frame1 = (images[frame_index] * 255).astype(np.uint8)
-        frame2 = (images[frame_index + 1] * 255).astype(np.uint8)
-        
-        flow = calculate_optical_flow(frame1, frame2, flow_method)
-        flow_magnitude = np.sqrt(flow[..., 0]**2 + flow[..., 1]**2)
-        
-        flow_magnitude[flow_magnitude < flow_threshold] = 0
-        
-        flow_magnitude[flow_magnitude < magnitude_threshold * np.max(flow_magnitude)] = 0
-        
-        flow_magnitude = normalize_array(flow_magnitude)
+        flow = calculate_optical_flow(images[frame_index], images[frame_index + 1], flow_method, self.flow_state)
+        flow_magnitude = cv2.magnitude(np.ascontiguousarray(flow[..., 0]), np.ascontiguousarray(flow[..., 1]))
+
+        # Both thresholds in one pass, the relative one uses the max before any values are zeroed
+        flow_magnitude[flow_magnitude < max(flow_threshold, magnitude_threshold * flow_magnitude.max())] = 0
+
+        cv2.normalize(flow_magnitude, flow_magnitude, 0, 1, cv2.NORM_MINMAX)
 
         return self.apply_flow_mask(mask, flow_magnitude, flow, strength, **kwargs)
 
@@ -621,19 +788,21 @@ class OpticalFlowMaskBase(MaskBase, ABC):
     def main_function(self, masks, images, strength, flow_method, flow_threshold, magnitude_threshold, **kwargs):
         masks_np = masks.cpu().numpy() if isinstance(masks, torch.Tensor) else masks
         images_np = images.cpu().numpy() if isinstance(images, torch.Tensor) else images
+
+        # Every frame except the first and last is used by two flow pairs, convert the clip once
+        images_uint8 = (images_np * 255).astype(np.uint8)
         
         num_frames = masks_np.shape[0]
         self.start_progress(num_frames, desc="Applying optical flow mask operation")
+        self.flow_state = OpticalFlowState()
 
-        result = []
+        processed_masks = np.empty(masks_np.shape, dtype=np.float32)
         for i in range(num_frames):
-            processed_mask = self.process_mask(masks_np[i], strength, images_np, flow_method, flow_threshold, magnitude_threshold, frame_index=i, **kwargs)
-            result.append(processed_mask)
+            processed_masks[i] = self.process_mask(masks_np[i], strength, images_uint8, flow_method, flow_threshold, magnitude_threshold, frame_index=i, **kwargs)
             self.update_progress()
 
         self.end_progress()
 
-        processed_masks = np.stack(result)
         return self.apply_mask_operation(processed_masks, masks, strength, **kwargs)
 
 
@@ -1,7 +1,8 @@
+import os
 import numpy as np
 import cv2
-from scipy import ndimage
-from scipy.ndimage import gaussian_filter
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 
 def apply_easing(t, easing_type):
@@ -16,84 +17,140 @@ def apply_easing(t, easing_type):
     else:
         return t  # Default to linear if invalid type
 
+# Temporal easing evaluates the same curve for every run with the same duration, keep it instead of recomputing the trig
+@lru_cache(maxsize=32)
+def easing_curve(num_samples, easing_type):
+    curve = apply_easing(np.linspace(0, 1, num_samples), easing_type)
+    curve.setflags(write=False)
+    return curve
+
 def create_distance_transform(mask):
     mask_8bit = (mask * 255).astype(np.uint8)
     return cv2.distanceTransform(mask_8bit, cv2.DIST_L2, 5)
 
 def normalize_array(arr):
-    return (arr - arr.min()) / (arr.max() - arr.min())
+    arr_min = arr.min()
+    # Divide the shifted copy in place instead of allocating a second temporary
+    result = np.subtract(arr, arr_min, dtype=arr.dtype if np.issubdtype(arr.dtype, np.floating) else np.float64)
+    result /= arr.max() - arr_min
+    return result
 
 def apply_blur(mask, blur_amount):
-    return ndimage.gaussian_filter(mask, sigma=blur_amount)
+    if blur_amount <= 0:
+        return mask.copy()
+    if mask.dtype not in (np.uint8, np.float32, np.float64):
+        mask = mask.astype(np.float32)
+    # Same 4 sigma truncation and reflected border as ndimage.gaussian_filter
+    ksize = 2 * int(4 * blur_amount + 0.5) + 1
+    return cv2.GaussianBlur(np.ascontiguousarray(mask), (ksize, ksize), sigmaX=blur_amount, sigmaY=blur_amount, borderType=cv2.BORDER_REFLECT)
+
+@lru_cache(maxsize=32)
+def rect_kernel(kernel_size):
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    kernel.setflags(write=False)
+    return kernel
 
 def morph_mask(mask, morph_type, kernel_size, iterations, progress_callback=None):
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    for _ in range(iterations):
-        if morph_type == "erode":
-            mask = cv2.erode(mask, kernel, iterations=1)
-        elif morph_type == "dilate":
-            mask = cv2.dilate(mask, kernel, iterations=1)
-        elif morph_type == "open":
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-        elif morph_type == "close":
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-        
-        if progress_callback:
+    if iterations > 0:
+        if morph_type in ("erode", "dilate"):
+            # N passes with a KxK box equal one pass with a ((K-1)*N+1) box anchored at the combined offset
+            size = (kernel_size - 1) * iterations + 1
+            anchor = iterations * (kernel_size // 2)
+            kernel = rect_kernel(size)
+            op = cv2.erode if morph_type == "erode" else cv2.dilate
+            mask = op(mask, kernel, anchor=(anchor, anchor), iterations=1)
+        elif morph_type in ("open", "close"):
+            # Opening and closing with a centered kernel are idempotent, even kernels shift and must be repeated
+            kernel = rect_kernel(kernel_size)
+            op = cv2.MORPH_OPEN if morph_type == "open" else cv2.MORPH_CLOSE
+            for _ in range(1 if kernel_size % 2 else iterations):
+                mask = cv2.morphologyEx(mask, op, kernel)
+
+    if progress_callback:
+        for _ in range(iterations):
             progress_callback()
     
     return mask
 
+def morph_mask_batch(masks, morph_type, kernel_size, iterations):
+    # OpenCV releases the GIL inside erode/dilate, so frames morph in parallel on plain threads
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return np.stack(list(executor.map(lambda mask: morph_mask(mask, morph_type, kernel_size, iterations), masks)))
+
 ###TRANSFORM
-def warp_affine(mask: np.ndarray, M: np.ndarray) -> np.ndarray:
+IDENTITY_AFFINE = np.float32([[1, 0, 0],
+                              [0, 1, 0]])
+
+def warp_affine(mask: np.ndarray, M: np.ndarray, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
+    # Zero strength frames produce the identity transform, which leaves the mask as it is
+    if np.array_equal(M, IDENTITY_AFFINE):
+        return mask.copy()
     height, width = mask.shape[:2]
-    return cv2.warpAffine(mask, M, (width, height), borderMode=cv2.BORDER_REPLICATE)
+    return cv2.warpAffine(mask, M, (width, height), flags=interpolation, borderMode=cv2.BORDER_REPLICATE)
 
-def translate_mask(mask: np.ndarray, x_value: float, y_value: float) -> np.ndarray:
+def translate_mask(mask: np.ndarray, x_value: float, y_value: float, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
     M = np.float32([[1, 0, x_value],
                     [0, 1, y_value]])
-    return warp_affine(mask, M)
+    return warp_affine(mask, M, interpolation)
 
-def rotate_mask(mask: np.ndarray, angle: float) -> np.ndarray:
+def rotate_mask(mask: np.ndarray, angle: float, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
     height, width = mask.shape[:2]
     center = (width // 2, height // 2)
     M = cv2.getRotationMatrix2D(center, angle, 1)
-    return warp_affine(mask, M)
+    return warp_affine(mask, M, interpolation)
 
-def scale_mask(mask: np.ndarray, scale_x: float, scale_y: float) -> np.ndarray:
-    height, width = mask.shape[:2]
-    M = cv2.getAffineTransform(
-        np.float32([[0, 0], [width, 0], [0, height]]),
-        np.float32([[0, 0], [width * scale_x, 0], [0, height * scale_y]])
-    )
-    return warp_affine(mask, M)
+def scale_mask(mask: np.ndarray, scale_x: float, scale_y: float, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
+    M = np.float32([[scale_x, 0, 0],
+                    [0, scale_y, 0]])
+    return warp_affine(mask, M, interpolation)
+
+def is_binary_mask(mask: np.ndarray) -> bool:
+    return mask.dtype == np.uint8 and not np.any((mask > 0) & (mask < mask.max()))
 
 def transform_mask(mask: np.ndarray, transform_type: str, x_value: float, y_value: float) -> np.ndarray:
+    # Hard edged masks keep their two values with a single nearest tap, soft masks are blended linearly
+    interpolation = cv2.INTER_NEAREST if is_binary_mask(mask) else cv2.INTER_LINEAR
     if transform_type == "translate":
-        return translate_mask(mask, x_value, y_value)
+        return translate_mask(mask, x_value, y_value, interpolation)
     elif transform_type == "rotate":
-        return rotate_mask(mask, x_value)
+        return rotate_mask(mask, x_value, interpolation)
     elif transform_type == "scale":
-        return scale_mask(mask, 1 + x_value, 1 + y_value)
+        return scale_mask(mask, 1 + x_value, 1 + y_value, interpolation)
     else:
         raise ValueError(f"Unknown transform type: {transform_type}")
 ###TRANSFORM
 
 
 ##MASK MATH
+# Each op scales mask_b into a single output buffer and finishes the expression in place
+def scaled_mask(mask_a: np.ndarray, mask_b: np.ndarray, strength: float) -> np.ndarray:
+    return np.multiply(mask_b, strength, dtype=np.result_type(mask_a, mask_b, np.float32))
+
 def add_masks(mask_a: np.ndarray, mask_b: np.ndarray, strength: float) -> np.ndarray:
-    return np.clip(mask_a + mask_b * strength, 0, 1)
+    result = scaled_mask(mask_a, mask_b, strength)
+    result += mask_a
+    return np.clip(result, 0, 1, out=result)
 
 def subtract_masks(mask_a: np.ndarray, mask_b: np.ndarray, strength: float) -> np.ndarray:
-    return np.clip(mask_a - mask_b * strength, 0, 1)
+    result = scaled_mask(mask_a, mask_b, strength)
+    np.subtract(mask_a, result, out=result)
+    return np.clip(result, 0, 1, out=result)
 
 def multiply_masks(mask_a: np.ndarray, mask_b: np.ndarray, strength: float) -> np.ndarray:
-    return mask_a * (mask_b * strength + (1 - strength))
+    result = scaled_mask(mask_a, mask_b, strength)
+    result += 1 - strength
+    result *= mask_a
+    return result
 
 def minimum_masks(mask_a: np.ndarray, mask_b: np.ndarray, strength: float) -> np.ndarray:
-    return np.minimum(mask_a, mask_b * strength + mask_a * (1 - strength))
+    result = scaled_mask(mask_a, mask_b, strength)
+    result += mask_a * (1 - strength)
+    return np.minimum(mask_a, result, out=result)
 
 def maximum_masks(mask_a: np.ndarray, mask_b: np.ndarray, strength: float) -> np.ndarray:
-    return np.maximum(mask_a, mask_b * strength + mask_a * (1 - strength))
+    result = scaled_mask(mask_a, mask_b, strength)
+    result += mask_a * (1 - strength)
+    return np.maximum(mask_a, result, out=result)
 
 def combine_masks(mask_a: np.ndarray, mask_b: np.ndarray, combination_method: str, strength: float) -> np.ndarray:
     if combination_method == "add":
@@ -113,40 +170,60 @@ def combine_masks(mask_a: np.ndarray, mask_b: np.ndarray, combination_method: st
 
 ###MASK WARP
 
+# PCG64 draws float32 directly into the scratch buffer, unlike the legacy float64 global generator
+NOISE_RNG = np.random.default_rng()
+
 def generate_perlin_noise(height: int, width: int, frequency: float, octaves: int) -> np.ndarray:
-    noise = np.zeros((2, height, width))
-    for _ in range(2):  # Generate noise for both x and y directions
-        for i in range(octaves):
-            freq = frequency * (2 ** i)
-            amp = 1.0 / (2 ** i)
-            noise[_] += amp * gaussian_filter((np.random.rand(height, width) * 2 - 1), sigma=1/freq)
+    noise = np.zeros((2, height, width), dtype=np.float32)
+    rand = np.empty((2, height, width), dtype=np.float32)
+    for i in range(octaves):
+        freq = frequency * (2 ** i)
+        amp = 1.0 / (2 ** i)
+        # One draw per octave covers both the x and y directions
+        NOISE_RNG.random((2, height, width), dtype=np.float32, out=rand)
+        rand *= 2
+        rand -= 1
+        for c in range(2):
+            blurred = apply_blur(rand[c], 1 / freq)
+            blurred *= amp
+            noise[c] += blurred
     return noise
 
+# Radial and swirl fields only depend on the frame size, every frame of a clip shares one read-only array
+@lru_cache(maxsize=8)
 def generate_radial_displacement(height: int, width: int) -> np.ndarray:
-    y, x = np.meshgrid(np.linspace(-1, 1, height), np.linspace(-1, 1, width), indexing='ij')
-    r = np.sqrt(x**2 + y**2)
-    theta = np.arctan2(y, x)
-    dx = r * np.cos(theta)
-    dy = r * np.sin(theta)
-    return np.stack([dx, dy])
-
+    # r * cos(theta) and r * sin(theta) are just the x and y coordinates
+    displacement = np.empty((2, height, width), dtype=np.float32)
+    displacement[0] = np.linspace(-1, 1, width, dtype=np.float32)[None, :]
+    displacement[1] = np.linspace(-1, 1, height, dtype=np.float32)[:, None]
+    displacement.setflags(write=False)
+    return displacement
+
+@lru_cache(maxsize=8)
 def generate_swirl_displacement(height: int, width: int) -> np.ndarray:
-    y, x = np.meshgrid(np.linspace(-1, 1, height), np.linspace(-1, 1, width), indexing='ij')
+    x = np.linspace(-1, 1, width, dtype=np.float32)[None, :]
+    y = np.linspace(-1, 1, height, dtype=np.float32)[:, None]
     r = np.sqrt(x**2 + y**2)
-    theta = np.arctan2(y, x)
-    dx = r * np.cos(theta + r)
-    dy = r * np.sin(theta + r)
-    return np.stack([dx, dy])
+    # r * cos(theta + r) and r * sin(theta + r) expanded with x = r * cos(theta), y = r * sin(theta)
+    cos_r = np.cos(r)
+    sin_r = np.sin(r)
+    displacement = np.empty((2, height, width), dtype=np.float32)
+    displacement[0] = x * cos_r - y * sin_r
+    displacement[1] = x * sin_r + y * cos_r
+    displacement.setflags(write=False)
+    return displacement
 
 def apply_displacement(mask: np.ndarray, displacement: np.ndarray, amplitude: float) -> np.ndarray:
     height, width = mask.shape
-    y, x = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
 
-    dx = displacement[0] * amplitude
-    dy = displacement[1] * amplitude
+    # Build the sample coordinates directly in float32, the pixel grid is broadcast instead of meshed
+    x_warped = np.multiply(displacement[0], amplitude, dtype=np.float32)
+    x_warped += np.arange(width, dtype=np.float32)
+    np.clip(x_warped, 0, width - 1, out=x_warped)
 
-    x_warped = np.clip(x + dx, 0, width - 1).astype(np.float32)
-    y_warped = np.clip(y + dy, 0, height - 1).astype(np.float32)
+    y_warped = np.multiply(displacement[1], amplitude, dtype=np.float32)
+    y_warped += np.arange(height, dtype=np.float32)[:, None]
+    np.clip(y_warped, 0, height - 1, out=y_warped)
 
     return cv2.remap(mask, x_warped, y_warped, cv2.INTER_LINEAR)
 
@@ -166,9 +243,28 @@ def warp_mask(mask: np.ndarray, warp_type: str, frequency: float, amplitude: flo
 
 ###MASK WARP
 
-def calculate_optical_flow(frame1, frame2, flow_method):
-    gray1 = cv2.cvtColor(frame1, cv2.COLOR_RGB2GRAY)
-    gray2 = cv2.cvtColor(frame2, cv2.COLOR_RGB2GRAY)
+class OpticalFlowState:
+    # Consecutive pairs share a frame, the gray version of the last frame2 is kept for the next frame1
+    def __init__(self):
+        self.frame = None
+        self.gray = None
+        self.spare = None
+
+    def matches(self, frame):
+        # The last frame2 is kept alive here, so its memory cannot be reused by another frame while it is compared against
+        return self.frame is not None and (frame is self.frame or (
+            frame.__array_interface__['data'][0] == self.frame.__array_interface__['data'][0]
+            and frame.shape == self.frame.shape and frame.strides == self.frame.strides))
+
+def calculate_optical_flow(frame1, frame2, flow_method, state=None):
+    if state is not None and state.matches(frame1):
+        gray1 = state.gray
+    else:
+        gray1 = cv2.cvtColor(frame1, cv2.COLOR_RGB2GRAY)
+    spare = state.spare if state is not None and state.spare is not None and state.spare.shape == frame2.shape[:2] else None
+    gray2 = cv2.cvtColor(frame2, cv2.COLOR_RGB2GRAY, dst=spare)
+    if state is not None:
+        state.frame, state.gray, state.spare = frame2, gray2, gray1
     height, width = gray1.shape
 
     if flow_method == "Farneback":
@@ -189,20 +285,20 @@ def calculate_optical_flow(frame1, frame2, flow_method):
         
         flow = np.zeros((height, width, 2), dtype=np.float32)
         if p1 is not None:
-            good_new = p1[st==1]
-            good_old = p0[st==1]
-            for i, (new, old) in enumerate(zip(good_new, good_old)):
-                a, b = new.ravel()
-                c, d = old.ravel()
-                if 0 <= int(b) < height and 0 <= int(a) < width:
-                    flow[int(b), int(a)] = [c-a, d-b]
-        
-        # Amplify the sparse flow
-        flow *= 25.0  # Increase this factor to make the effect stronger
+            # (N, 1, 2) point arrays as (N, 2) x/y columns, keeping only the tracked points
+            tracked = st.ravel() == 1
+            good_new = p1.reshape(-1, 2)[tracked]
+            good_old = p0.reshape(-1, 2)[tracked]
+            cols = good_new[:, 0].astype(np.int32)
+            rows = good_new[:, 1].astype(np.int32)
+            inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+            # Scatter the amplified displacements at their new positions, later points win on collisions.
+            # Everything else is zero, so amplifying the points equals amplifying the whole sparse flow
+            flow[rows[inside], cols[inside]] = (good_old[inside] - good_new[inside]) * 25.0  # Increase this factor to make the effect stronger
         
-        # Convert sparse flow to dense flow
-        dense_flow = cv2.dilate(flow, None, iterations=3)
-        dense_flow = cv2.GaussianBlur(dense_flow, (15, 15), 0)  # Increased kernel size for more spread
+        # Convert sparse flow to dense flow, one 7x7 dilation covers the same footprint as three 3x3 passes
+        dense_flow = cv2.dilate(flow, rect_kernel(7))
+        cv2.GaussianBlur(dense_flow, (15, 15), 0, dst=dense_flow)  # Increased kernel size for more spread
         
         # Further amplify the dense flow
         dense_flow *= 20.0  # Increase this factor to make the effect even stronger
@@ -2,7 +2,7 @@ import numpy as np
 import cv2
 import torch
 from .mask_base import OpticalFlowMaskBase
-from .mask_utils import calculate_optical_flow, apply_blur, normalize_array
+from .mask_utils import calculate_optical_flow, apply_blur, normalize_array, OpticalFlowState
 
 
 #TODO make all this better.
@@ -120,7 +120,7 @@ class OpticalFlowDirectionMask(OpticalFlowMaskBase):
             radial_angle[radial_angle < 0] += 360
             mask = np.abs(angle - (radial_angle - 90) % 360) < angle_threshold
 
-        mask = mask.astype(float)
+        mask = mask.astype(np.float32)
         mask *= flow_magnitude
 
         if blur_radius > 0:
@@ -225,11 +225,11 @@ class OpticalFlowParticleSystem(OpticalFlowMaskBase):
         self.particle_lifetime = particle_lifetime
         self.particles = np.array([])
 
-        for i in range(len(images_np) - 1):
-            frame1 = (images_np[i] * 255).astype(np.uint8)
-            frame2 = (images_np[i + 1] * 255).astype(np.uint8)
+        images_uint8 = (images_np * 255).astype(np.uint8)
+        flow_state = OpticalFlowState()
 
-            flow = calculate_optical_flow(frame1, frame2, flow_method)
+        for i in range(len(images_np) - 1):
+            flow = calculate_optical_flow(images_uint8[i], images_uint8[i + 1], flow_method, flow_state)
 
             # Emit new particles
             new_particles = self.emit_particles(num_particles // particle_lifetime, masks_np[i], initial_velocity)
@@ -17,6 +17,7 @@ class ParticleEmissionMask(ParticleSystemMaskBase):
                 "wells": ("GRAVITY_WELL",),
                 "well_strength_multiplier": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.1}),
                 "draw_modifiers": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "particle_collisions": ("BOOLEAN", {"default": True}),
             }
         }
 
@@ -53,7 +54,7 @@ class ParticleEmissionMask(ParticleSystemMaskBase):
                 cv2.circle(particle_image, (int(well['position'].x), int(well['position'].y)), 
                         int(well['radius']), (1, color, 0), thickness)  # Red/Orange color for wells
 
-        result_image = np.maximum(particle_image, np.stack([mask] * 3, axis=-1))
+        result_image = np.maximum(particle_image, mask[..., None], out=particle_image)
         
         return result_mask, result_image
 